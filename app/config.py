@@ -1,6 +1,8 @@
+from pydantic import field_validator
 from pydantic_settings import BaseSettings
 from typing import List, Optional
 from pathlib import Path
+from functools import cached_property, lru_cache
 import os
 
 class Settings(BaseSettings):
@@ -15,13 +17,27 @@ class Settings(BaseSettings):
     max_file_size: int = int(os.getenv("MAX_FILE_SIZE", str(5 * 1024 * 1024 * 1024)))  # 5GB default
     max_concurrent_downloads: int = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "3"))
     job_ttl_hours: int = int(os.getenv("JOB_TTL_HOURS", "24"))
+    max_jobs: int = int(os.getenv("MAX_JOBS", "10000"))
+    probe_cache_ttl: int = int(os.getenv("PROBE_CACHE_TTL", "300"))  # seconds
+    probe_cache_size: int = int(os.getenv("PROBE_CACHE_SIZE", "512"))
+    # Probes are network-bound and not semaphore limited; same default as asyncio's pool
+    probe_workers: int = int(os.getenv("PROBE_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
     rate_limit_per_minute: int = int(os.getenv("RATE_LIMIT_PER_MINUTE", "20"))
+    rate_limit_max_clients: int = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000"))
+    # Shared rate limiting across workers; local limiter is used when unset
+    redis_url: Optional[str] = os.getenv("REDIS_URL")
+    
+    # Eviction needs room for at least one job, a pool for at least one thread
+    @field_validator("max_jobs", "probe_workers")
+    @classmethod
+    def clamp_to_one(cls, v: int) -> int:
+        return max(1, v)
     
     # Security
     secret_key: str = os.getenv("SECRET_KEY", "change-this-secret-key")
     
-    # Парсим allowed_origins из переменной окружения
-    @property
+    # Парсим allowed_origins из переменной окружения (один раз)
+    @cached_property
     def allowed_origins(self) -> List[str]:
         origins = os.getenv("ALLOWED_ORIGINS", "https://video.vitalyor.online,http://localhost:8000")
         return [origin.strip() for origin in origins.split(",")]
@@ -35,13 +51,26 @@ class Settings(BaseSettings):
         "reddit.com", "v.redd.it",
         "facebook.com", "fb.watch"
     ]
+
+    # Exact hosts and ".domain" suffixes for subdomains, built once
+    @cached_property
+    def allowed_domain_set(self) -> frozenset:
+        return frozenset(self.allowed_domains)
+
+    @cached_property
+    def allowed_domain_suffixes(self) -> tuple:
+        return tuple("." + domain for domain in self.allowed_domains)
     
     class Config:
         env_file = ".env"
         env_file_encoding = 'utf-8'
         env_ignore_empty = True
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    return Settings()
+
+settings = get_settings()
 
 # Создаём необходимые директории
 settings.temp_dir.mkdir(parents=True, exist_ok=True)
@@ -6,20 +6,24 @@ from fastapi import (
     WebSocket,
     WebSocketDisconnect,
 )
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
+from typing import Dict
 import asyncio
+import orjson
 import uuid
 import os
 from contextlib import asynccontextmanager
 
 from app.config import settings
-from app.models import DownloadRequest, ProbeResponse
-from app.services.job_manager import job_manager
+from app.models import DownloadRequest, JobStatus, ProbeResponse
+from app.services.job_manager import JobLimitExceeded, job_manager
 from app.services.downloader import downloader
+from app.services.rate_limiter import rate_limiter
+from app.middleware import RateLimitMiddleware
 
 # Templates
 templates = Jinja2Templates(directory=str(Path(__file__).parent / "templates"))
@@ -29,9 +33,12 @@ templates = Jinja2Templates(directory=str(Path(__file__).parent / "templates"))
 async def lifespan(app: FastAPI):
     # Startup
     await job_manager.start()
+    await rate_limiter.start()
     yield
     # Shutdown
     await job_manager.stop()
+    await rate_limiter.stop()
+    downloader.shutdown()
 
 
 # Create app
@@ -42,6 +49,9 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
+# Rate limiting (registered before CORS so 429s still carry CORS headers)
+app.add_middleware(RateLimitMiddleware, paths=("/probe", "/download"))
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -51,32 +61,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Rate limiting
-from typing import Dict
-from datetime import datetime, timedelta
-
-rate_limit_store: Dict[str, list] = {}
-
-
-def check_rate_limit(client_ip: str) -> bool:
-    """Simple rate limiting"""
-    now = datetime.now()
-    minute_ago = now - timedelta(minutes=1)
-
-    if client_ip not in rate_limit_store:
-        rate_limit_store[client_ip] = []
 
-    # Clean old entries
-    rate_limit_store[client_ip] = [
-        t for t in rate_limit_store[client_ip] if t > minute_ago
-    ]
+class LargeFileResponse(FileResponse):
+    """FileResponse reading 1 MiB chunks, so multi-GB videos need fewer thread hops"""
 
-    # Check limit
-    if len(rate_limit_store[client_ip]) >= settings.rate_limit_per_minute:
-        return False
-
-    rate_limit_store[client_ip].append(now)
-    return True
+    chunk_size = 1024 * 1024
 
 
 # Routes
@@ -85,21 +74,16 @@ async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
-@app.post("/probe")
-async def probe_formats(request: Request, url: str = Form(...)):
+@app.post("/probe", response_model=ProbeResponse)
+async def probe_formats(url: str = Form(...)) -> Response:
     """Get available formats for a video"""
-    client_ip = request.client.host
-
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-
     try:
         # Validate URL
         req = DownloadRequest(url=url, fmt="best")  # fmt is dummy here
 
-        # Get formats
-        result = await downloader.probe_formats(str(req.url))
-        return ProbeResponse(**result)
+        # Get formats (already JSON-encoded)
+        content = await downloader.probe_formats(str(req.url))
+        return Response(content=content, media_type="application/json")
 
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -108,13 +92,10 @@ async def probe_formats(request: Request, url: str = Form(...)):
 
 
 @app.post("/download")
-async def start_download(request: Request, url: str = Form(...), fmt: str = Form(...)):
+async def start_download(
+    url: str = Form(...), fmt: str = Form(...)
+) -> Dict[str, str]:
     """Start video download"""
-    client_ip = request.client.host
-
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-
     try:
         # Validate request
         req = DownloadRequest(url=url, fmt=fmt)
@@ -126,8 +107,10 @@ async def start_download(request: Request, url: str = Form(...), fmt: str = Form
         # Start download task
         asyncio.create_task(downloader.download(job_id, str(req.url), req.fmt))
 
-        return JSONResponse({"job_id": job_id})
+        return {"job_id": job_id}
 
+    except JobLimitExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -136,14 +119,14 @@ async def start_download(request: Request, url: str = Form(...), fmt: str = Form
         )
 
 
-@app.get("/progress/{job_id}")
-async def get_progress(job_id: str):
+@app.get("/progress/{job_id}", response_model=JobStatus)
+async def get_progress(job_id: str) -> Response:
     """Get job progress"""
     job = await job_manager.get_job(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
 
-    return job.dict()
+    return Response(content=orjson.dumps(job), media_type="application/json")
 
 
 @app.get("/fetch/{job_id}")
@@ -157,7 +140,12 @@ async def fetch_file(job_id: str):
     if job.status != "finished":
         raise HTTPException(status_code=400, detail="File is not ready")
 
-    if not job.filepath or not Path(job.filepath).exists():
+    # Stat once: doubles as the existence check and feeds the response headers
+    try:
+        stat_result = os.stat(job.filepath) if job.filepath else None
+    except OSError:
+        stat_result = None
+    if stat_result is None:
         raise HTTPException(status_code=404, detail="File not found")
 
     # Schedule cleanup after download
@@ -167,10 +155,11 @@ async def fetch_file(job_id: str):
 
     asyncio.create_task(cleanup())
 
-    return FileResponse(
+    return LargeFileResponse(
         path=job.filepath,
         filename=job.filename or "video.mp4",
         media_type="application/octet-stream",
+        stat_result=stat_result,
     )
 
 
@@ -184,7 +173,7 @@ async def websocket_progress(websocket: WebSocket, job_id: str):
         # Send current status
         job = await job_manager.get_job(job_id)
         if job:
-            await websocket.send_json(job.dict())
+            await websocket.send_bytes(orjson.dumps(job))
 
         # Keep connection alive
         while True:
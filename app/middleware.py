@@ -0,0 +1,37 @@
+from typing import Iterable
+from starlette.types import ASGIApp, Receive, Scope, Send
+from app.services.rate_limiter import rate_limiter
+
+RATE_LIMIT_BODY = b'{"detail":"Rate limit exceeded"}'
+
+
+class RateLimitMiddleware:
+    """Pure ASGI rate limiting, rejects before the request body is read"""
+
+    def __init__(self, app: ASGIApp, paths: Iterable[str] = ()):
+        self.app = app
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get("client")
+        client_ip = client[0] if client else ""
+
+        if await rate_limiter.check(client_ip):
+            await self.app(scope, receive, send)
+            return
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(RATE_LIMIT_BODY)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": RATE_LIMIT_BODY})
@@ -1,33 +1,45 @@
-from pydantic import BaseModel, HttpUrl, validator
+from pydantic import BaseModel, ConfigDict, HttpUrl, field_validator
 from typing import Optional, Literal, Dict, Any, List, Union
+from dataclasses import dataclass, field
 from datetime import datetime
-from urllib.parse import urlparse
 from app.config import settings
 
+# Characters never allowed in a yt-dlp format spec
+FMT_FORBIDDEN_CHARS = frozenset(';&|`$()\n\r')
+
 class DownloadRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     url: HttpUrl
     fmt: str
     
-    @validator('url')
+    @field_validator('url')
+    @classmethod
     def validate_url(cls, v):
-        parsed = urlparse(str(v))
-        domain = parsed.netloc.lower().replace('www.', '')
+        # HttpUrl is already parsed by pydantic-core
+        domain = (v.host or '').lower()
         
-        # Check if domain is allowed
-        if not any(allowed in domain for allowed in settings.allowed_domains):
+        # Allow listed domains and their subdomains only
+        if not (
+            domain in settings.allowed_domain_set
+            or domain.endswith(settings.allowed_domain_suffixes)
+        ):
             raise ValueError(f'Unsupported domain: {domain}')
         return v
     
-    @validator('fmt')
+    @field_validator('fmt')
+    @classmethod
     def validate_format(cls, v):
         if not v or len(v) > 500:
             raise ValueError('Invalid format specification')
         # Prevent command injection
-        if any(char in v for char in [';', '&', '|', '`', '$', '(', ')', '\n', '\r']):
+        if not FMT_FORBIDDEN_CHARS.isdisjoint(v):
             raise ValueError('Invalid characters in format')
         return v
 
-class JobStatus(BaseModel):
+@dataclass(slots=True)
+class JobStatus:
+    """Internal job state; mutated on every progress tick, so not a pydantic model"""
     job_id: str
     status: Literal["queued", "starting", "downloading", "postprocessing", "finished", "error", "cancelled"]
     percent: Optional[str] = None
@@ -38,15 +50,8 @@ class JobStatus(BaseModel):
     filename: Optional[str] = None
     filepath: Optional[str] = None
     error: Optional[str] = None
-    created_at: datetime = None
-    updated_at: datetime = None
-    
-    def __init__(self, **data):
-        if 'created_at' not in data or data['created_at'] is None:
-            data['created_at'] = datetime.now()
-        if 'updated_at' not in data or data['updated_at'] is None:
-            data['updated_at'] = datetime.now()
-        super().__init__(**data)
+    created_at: datetime = field(default_factory=datetime.now)
+    updated_at: datetime = field(default_factory=datetime.now)
 
 class VideoFormat(BaseModel):
     id: str
@@ -61,13 +66,15 @@ class VideoFormat(BaseModel):
     acodec: Optional[str] = None
     fmt: str
     
-    @validator('fps', pre=True)
+    @field_validator('fps', mode='before')
+    @classmethod
     def convert_fps(cls, v):
         if v is not None and isinstance(v, (int, float)):
             return int(v)
         return v
     
-    @validator('tbr', pre=True)
+    @field_validator('tbr', mode='before')
+    @classmethod
     def convert_tbr(cls, v):
         if v is not None and isinstance(v, (int, float)):
             return round(v)
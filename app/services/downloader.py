@@ -1,59 +1,145 @@
-import yt_dlp
 import asyncio
+import logging
 import tempfile
 import subprocess
 import shutil
+import threading
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import TYPE_CHECKING, Dict, Any, Optional, Tuple
+from cachetools import TTLCache
 from app.config import settings
 from app.services.job_manager import job_manager
-from app.models import VideoFormat
+from app.models import ProbeResponse, VideoFormat
+from app.services.faststart import faststart
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+log = logging.getLogger(__name__)
+
+# Resolved once; PATH does not change while the server runs
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+HTTP_HEADERS = {
+    "User-Agent": USER_AGENT,
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Format string for video-only formats, paired with the best audio track
+VIDEO_FMT_TEMPLATE = "%s+bestaudio[ext=m4a]/bestaudio"
 
 # Remove ANSI color codes
 ANSI_ESCAPE = re.compile(r"\x1B\[[0-?]*[ -/]*[@-~]")
 
 
+def _format_sort_key(f: VideoFormat) -> Tuple[int, int, int]:
+    """Muxed formats first, then by height and bitrate descending"""
+    return (0 if f.type == "av" else 1, -(f.height or 0), -(f.tbr or 0))
+
+
 class VideoDownloader:
     def __init__(self):
         self.semaphore = asyncio.Semaphore(settings.max_concurrent_downloads)
-        self.user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-
-    def _get_base_options(self) -> Dict[str, Any]:
-        """Base yt-dlp options"""
-        return {
+        # Each download holds the semaphore and runs its blocking steps one
+        # after another, so one thread per download slot is enough
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.max_concurrent_downloads,
+            thread_name_prefix="download",
+        )
+        # Probes get their own pool so they never wait behind long downloads
+        self.probe_executor = ThreadPoolExecutor(
+            max_workers=settings.probe_workers,
+            thread_name_prefix="probe",
+        )
+        self._probe_cache: TTLCache = TTLCache(
+            maxsize=settings.probe_cache_size, ttl=settings.probe_cache_ttl
+        )
+        self._probe_inflight: Dict[str, asyncio.Future] = {}
+        self._base_options: Dict[str, Any] = {
             "quiet": True,
             "no_color": True,
             "noplaylist": True,
-            "http_headers": {
-                "User-Agent": self.user_agent,
-                "Accept-Language": "en-US,en;q=0.9",
-            },
         }
+        self._cookies_file = settings.cookies_dir / "cookies.txt"
+        # Resolved on first use by whichever worker thread gets there first
+        self._cookie_option: Optional[Dict[str, Any]] = None
+        self._cookie_lock = threading.Lock()
 
-    def _get_cookie_options(self) -> List[Dict[str, Any]]:
-        """Get cookie options to try"""
-        options = []
+    def _get_base_options(self) -> Dict[str, Any]:
+        """Base yt-dlp options, copied from the template built at init"""
+        opts = self._base_options.copy()
+        opts["http_headers"] = HTTP_HEADERS.copy()
+        return opts
+
+    def _get_cookie_option(self) -> Dict[str, Any]:
+        """Get the cookie option to use, resolved once per process.
+
+        cookies.txt is not watched: yt-dlp writes it back whenever a
+        YoutubeDL instance closes, so its mtime cannot detect operator edits.
+        Restart the app after replacing it.
+        """
+        if self._cookie_option is None:
+            with self._cookie_lock:
+                if self._cookie_option is None:
+                    cookies_file = self._cookies_file
+                    self._cookie_option = self._resolve_cookie_option(
+                        cookies_file if cookies_file.exists() else None
+                    )
+        return self._cookie_option
+
+    def _resolve_cookie_option(self, cookies_file: Optional[Path]) -> Dict[str, Any]:
+        """Pick the first cookie source that loads, without touching the network"""
+        import yt_dlp
+        from yt_dlp.cookies import load_cookies
+
+        candidates = []
 
         # Try cookies file if exists
-        cookies_file = settings.cookies_dir / "cookies.txt"
-        if cookies_file.exists():
-            options.append(
+        if cookies_file:
+            candidates.append(
                 {"cookiesfrombrowser": None, "cookiefile": str(cookies_file)}
             )
 
         # Try browser cookies
         for browser in ["chrome", "firefox", "edge"]:
-            options.append({"cookiesfrombrowser": (browser,)})
+            candidates.append({"cookiesfrombrowser": (browser,)})
 
-        # No cookies
-        options.append({})
+        # Only used for load_cookies' logging and never closed, since close()
+        # would write the jar back to cookies.txt
+        ydl = yt_dlp.YoutubeDL(self._get_base_options())
+        for option in candidates:
+            try:
+                load_cookies(
+                    option.get("cookiefile"), option["cookiesfrombrowser"], ydl
+                )
+            except Exception:
+                log.debug("Cookie source %s unavailable", option, exc_info=True)
+                continue
+
+            cookiefile = option.get("cookiefile")
+            if cookiefile and not os.access(cookiefile, os.W_OK):
+                # yt-dlp saves the jar on close, which fails on a read-only
+                # mount; give it a private writable copy instead
+                copy = settings.temp_dir / "cookies.txt"
+                shutil.copyfile(cookiefile, copy)
+                option = {**option, "cookiefile": str(copy)}
 
-        return options
+            log.info("Using cookie source %s", option)
+            return option
+
+        # No cookies
+        log.info("No cookie source available, downloading without cookies")
+        return {}
 
     def _create_progress_hook(self, job_id: str, loop: asyncio.AbstractEventLoop):
         """Create progress hook for yt-dlp"""
+        _sub = ANSI_ESCAPE.sub
+        update_state = job_manager.update_state
 
         def hook(d):
             if d["status"] == "downloading":
@@ -61,13 +147,17 @@ class VideoDownloader:
                 speed = d.get("_speed_str", "")
                 eta = d.get("_eta_str", "")
 
-                # Clean ANSI codes
-                percent = ANSI_ESCAPE.sub("", percent).strip()
-                speed = ANSI_ESCAPE.sub("", speed).strip()
-                eta = ANSI_ESCAPE.sub("", eta).strip()
-
-                asyncio.run_coroutine_threadsafe(
-                    job_manager.update_job(
+                # Clean ANSI codes (rare with no_color, so check before the regex)
+                percent = (
+                    percent if "\x1b" not in percent else _sub("", percent)
+                ).strip()
+                speed = (speed if "\x1b" not in speed else _sub("", speed)).strip()
+                eta = (eta if "\x1b" not in eta else _sub("", eta)).strip()
+
+                # Plain callback on the loop thread, no coroutine/Future per tick
+                loop.call_soon_threadsafe(
+                    partial(
+                        update_state,
                         job_id,
                         status="downloading",
                         percent=percent,
@@ -76,72 +166,75 @@ class VideoDownloader:
                         downloaded_bytes=d.get("downloaded_bytes"),
                         total_bytes=d.get("total_bytes")
                         or d.get("total_bytes_estimate"),
-                    ),
-                    loop,
+                    )
                 )
             elif d["status"] == "finished":
-                asyncio.run_coroutine_threadsafe(
-                    job_manager.update_job(
-                        job_id, status="postprocessing", percent="100%"
-                    ),
-                    loop,
+                loop.call_soon_threadsafe(
+                    partial(
+                        update_state, job_id, status="postprocessing", percent="100%"
+                    )
                 )
 
         return hook
 
-    async def probe_formats(self, url: str) -> Dict[str, Any]:
+    async def probe_formats(self, url: str) -> bytes:
+        """Get encoded ProbeResponse JSON for a video, cached per URL"""
+        cached = self._probe_cache.get(url)
+        if cached is not None:
+            return cached
+
+        # Concurrent probes of the same URL share a single yt-dlp call
+        task = self._probe_inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._probe_formats(url))
+            task.add_done_callback(lambda t: self._on_probe_done(url, t))
+            self._probe_inflight[url] = task
+
+        # Shield so one disconnecting client does not cancel the others
+        return await asyncio.shield(task)
+
+    def _on_probe_done(self, url: str, task: asyncio.Future):
+        """Cache successful probe results"""
+        self._probe_inflight.pop(url, None)
+        if not task.cancelled() and task.exception() is None:
+            self._probe_cache[url] = task.result()
+
+    async def _probe_formats(self, url: str) -> bytes:
         """Extract available formats for a video"""
         loop = asyncio.get_event_loop()
 
         def _extract():
-            last_error = None
-            for cookie_opt in self._get_cookie_options():
-                opts = self._get_base_options()
-                opts.update(cookie_opt)
+            # Imported on first use, yt_dlp pulls in every extractor
+            import yt_dlp
 
-                try:
-                    with yt_dlp.YoutubeDL(opts) as ydl:
-                        return ydl.extract_info(url, download=False)
-                except Exception as e:
-                    last_error = e
-                    continue
+            opts = self._get_base_options()
+            opts.update(self._get_cookie_option())
 
-            if last_error:
-                raise last_error
-            raise Exception("Failed to extract video information")
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                return ydl.extract_info(url, download=False)
 
-        info = await loop.run_in_executor(None, _extract)
+        info = await loop.run_in_executor(self.probe_executor, _extract)
 
-        # Process formats
+        # Process formats in a single pass, skipping non-video entries early
         formats = []
         for f in info.get("formats", []):
-            if not f.get("format_id"):
+            format_id = f.get("format_id")
+            if not format_id:
                 continue
 
             vcodec = f.get("vcodec")
+            if not vcodec or vcodec == "none":
+                continue
             acodec = f.get("acodec")
-            has_video = vcodec and vcodec != "none"
             has_audio = acodec and acodec != "none"
 
-            # Determine type
-            if has_video and has_audio:
-                fmt_type = "av"
-            elif has_video:
-                fmt_type = "video"
-            elif has_audio:
-                fmt_type = "audio"
-            else:
-                fmt_type = "other"
-
-            # Skip non-video formats for simplicity
-            if fmt_type not in ("av", "video"):
-                continue
-
             # Build format string (add audio for video-only)
-            if fmt_type == "video":
-                fmt_str = f"{f['format_id']}+bestaudio[ext=m4a]/bestaudio"
+            if has_audio:
+                fmt_type = "av"
+                fmt_str = format_id
             else:
-                fmt_str = f["format_id"]
+                fmt_type = "video"
+                fmt_str = VIDEO_FMT_TEMPLATE % format_id
 
             # Безопасное получение числовых значений
             fps_value = f.get("fps")
@@ -156,19 +249,19 @@ class VideoDownloader:
                     round(tbr_value) if isinstance(tbr_value, (int, float)) else None
                 )
 
+            width = f.get("width")
+            height = f.get("height")
+
+            # Values are already normalised above, so skip validation
             formats.append(
-                VideoFormat(
-                    id=f["format_id"],
+                VideoFormat.model_construct(
+                    id=format_id,
                     type=fmt_type,
-                    label=self._build_format_label(f),
+                    label=self._build_format_label(f, True, bool(has_audio)),
                     ext=f.get("ext"),
-                    res=(
-                        f"{f.get('width')}x{f.get('height')}"
-                        if f.get("width") and f.get("height")
-                        else None
-                    ),
+                    res=f"{width}x{height}" if width and height else None,
                     fps=fps_value,
-                    height=f.get("height"),
+                    height=height,
                     tbr=tbr_value,
                     vcodec=vcodec,
                     acodec=acodec,
@@ -177,63 +270,52 @@ class VideoDownloader:
             )
 
         # Sort formats
-        formats.sort(
-            key=lambda x: (0 if x.type == "av" else 1, -(x.height or 0), -(x.tbr or 0))
-        )
+        formats.sort(key=_format_sort_key)
 
-        return {
-            "meta": {
+        response = ProbeResponse.model_construct(
+            meta={
                 "title": info.get("title"),
                 "duration": info.get("duration"),
                 "thumbnail": info.get("thumbnail"),
             },
-            "formats": [f.dict() for f in formats],
-        }
+            formats=formats,
+        )
 
-    def _build_format_label(self, f: Dict) -> str:
-        """Build human-readable format label"""
-        parts = []
-
-        # Type
-        vcodec = f.get("vcodec")
-        acodec = f.get("acodec")
-        if vcodec and vcodec != "none" and acodec and acodec != "none":
-            parts.append("AV")
-        elif vcodec and vcodec != "none":
-            parts.append("VIDEO")
-        elif acodec and acodec != "none":
-            parts.append("AUDIO")
-
-        # Resolution
-        if f.get("height"):
-            parts.append(f"{f['height']}p")
-
-        # FPS
-        if f.get("fps"):
-            fps_val = int(f["fps"]) if isinstance(f["fps"], (int, float)) else f["fps"]
-            parts.append(f"{fps_val}fps")
-
-        # Extension
-        if f.get("ext"):
-            parts.append(f["ext"].upper())
-
-        # Bitrate
-        if f.get("tbr"):
-            tbr_val = (
-                round(f["tbr"]) if isinstance(f["tbr"], (int, float)) else f["tbr"]
-            )
-            parts.append(f"{tbr_val}k")
+        # Encode once with pydantic-core; cache hits reuse the bytes as-is
+        return response.model_dump_json().encode()
 
-        # File size
+    def _build_format_label(self, f: Dict, has_video: bool, has_audio: bool) -> str:
+        """Build human-readable format label"""
+        if has_video:
+            type_str = "AV" if has_audio else "VIDEO"
+        else:
+            type_str = "AUDIO" if has_audio else None
+
+        height = f.get("height")
+        fps = f.get("fps")
+        ext = f.get("ext")
+        tbr = f.get("tbr")
         size = f.get("filesize") or f.get("filesize_approx")
-        if size:
-            size_str = self._format_size(size)
-            parts.append(f"~{size_str}")
 
-        return " • ".join(parts)
+        # Missing values short-circuit to falsy and are dropped by filter
+        return " • ".join(
+            filter(
+                None,
+                (
+                    type_str,
+                    height and f"{height}p",
+                    fps and f"{int(fps) if isinstance(fps, (int, float)) else fps}fps",
+                    ext and ext.upper(),
+                    tbr and f"{round(tbr) if isinstance(tbr, (int, float)) else tbr}k",
+                    size and f"~{self._format_size(size)}",
+                ),
+            )
+        )
 
-    def _format_size(self, bytes_val: int) -> str:
-        """Format bytes to human readable"""
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _format_size(bytes_val: int) -> str:
+        """Format bytes to human readable (memoized, sizes repeat across probes)"""
         if not bytes_val:
             return ""
         units = ["B", "KB", "MB", "GB", "TB"]
@@ -244,6 +326,11 @@ class VideoDownloader:
             unit_index += 1
         return f"{value:.1f} {units[unit_index]}"
 
+    def shutdown(self):
+        """Stop the download and probe thread pools"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.probe_executor.shutdown(wait=False, cancel_futures=True)
+
     async def download(self, job_id: str, url: str, fmt: str):
         """Download video with given format"""
         async with self.semaphore:
@@ -263,34 +350,24 @@ class VideoDownloader:
 
             # Download
             def _download():
-                last_error = None
-                for cookie_opt in self._get_cookie_options():
-                    opts = self._get_base_options()
-                    opts.update(
-                        {
-                            "format": fmt,
-                            "outtmpl": str(temp_dir / "%(title)s.%(ext)s"),
-                            "progress_hooks": [
-                                self._create_progress_hook(job_id, loop)
-                            ],
-                            "merge_output_format": "mp4",
-                        }
-                    )
-                    opts.update(cookie_opt)
+                import yt_dlp
 
-                    try:
-                        with yt_dlp.YoutubeDL(opts) as ydl:
-                            info = ydl.extract_info(url, download=True)
-                            return self._resolve_output_path(ydl, info, temp_dir)
-                    except Exception as e:
-                        last_error = e
-                        continue
+                opts = self._get_base_options()
+                opts.update(
+                    {
+                        "format": fmt,
+                        "outtmpl": str(temp_dir / "%(title)s.%(ext)s"),
+                        "progress_hooks": [self._create_progress_hook(job_id, loop)],
+                        "merge_output_format": "mp4",
+                    }
+                )
+                opts.update(self._get_cookie_option())
 
-                if last_error:
-                    raise last_error
-                raise Exception("Download failed")
+                with yt_dlp.YoutubeDL(opts) as ydl:
+                    info = ydl.extract_info(url, download=True)
+                    return self._resolve_output_path(ydl, info, temp_dir)
 
-            filepath = await loop.run_in_executor(None, _download)
+            filepath = await loop.run_in_executor(self.executor, _download)
 
             # Post-process if needed
             await job_manager.update_job(job_id, status="postprocessing")
@@ -301,6 +378,11 @@ class VideoDownloader:
             if file_size > settings.max_file_size:
                 raise Exception(f"File too large: {file_size / 1024 / 1024:.1f}MB")
 
+            # Job was removed while downloading; nobody will clean up the file
+            if job_id not in job_manager.jobs:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                return
+
             # Update job as finished
             await job_manager.update_job(
                 job_id,
@@ -320,30 +402,30 @@ class VideoDownloader:
             raise
 
     def _resolve_output_path(
-        self, ydl: yt_dlp.YoutubeDL, info: Dict, temp_dir: Path
+        self, ydl: "yt_dlp.YoutubeDL", info: Dict, temp_dir: Path
     ) -> Path:
         """Find the actual output file"""
         filename = ydl.prepare_filename(info)
         base = Path(filename).stem
 
+        # One directory pass instead of a stat per candidate
+        with os.scandir(temp_dir) as it:
+            files = {entry.name: entry.path for entry in it if entry.is_file()}
+
         # Try common extensions
         for ext in (".mp4", ".mkv", ".webm", ".m4a", ".mp3"):
-            candidate = temp_dir / f"{base}{ext}"
-            if candidate.exists():
-                return candidate
+            path = files.get(f"{base}{ext}")
+            if path:
+                return Path(path)
 
-        # Fallback - find any file in temp dir
-        files = list(temp_dir.glob("*"))
+        # Fallback - any file in temp dir
         if files:
-            return files[0]
+            return Path(next(iter(files.values())))
 
         raise Exception("Output file not found")
 
     async def _ensure_compatible_format(self, filepath: Path) -> Path:
         """Ensure video is in a compatible format"""
-        if not shutil.which("ffmpeg"):
-            return filepath
-
         # Only process MP4 files
         if filepath.suffix.lower() != ".mp4":
             return filepath
@@ -351,13 +433,22 @@ class VideoDownloader:
         loop = asyncio.get_event_loop()
 
         def _process():
+            # Move moov to the front without ffmpeg. This is a no-op for files
+            # already faststart, which includes every file yt-dlp merged
+            if faststart(filepath):
+                return
+
+            # Unsupported layout (fragmented, compressed moov, ...): remux
+            if FFMPEG_PATH is None:
+                return
+
             # Create temp file
             temp_file = filepath.with_suffix(".temp.mp4")
 
             try:
                 # Remux with faststart
                 cmd = [
-                    "ffmpeg",
+                    FFMPEG_PATH,
                     "-y",
                     "-i",
                     str(filepath),
@@ -375,15 +466,14 @@ class VideoDownloader:
                 )
 
                 if result.returncode == 0 and temp_file.exists():
-                    # Replace original with processed file
-                    filepath.unlink()
-                    temp_file.rename(filepath)
-            except:
+                    # Atomically replace original with processed file
+                    os.replace(temp_file, filepath)
+            except Exception:
+                log.debug("ffmpeg remux of %s failed", filepath, exc_info=True)
                 # Cleanup temp file on error
-                if temp_file.exists():
-                    temp_file.unlink()
+                temp_file.unlink(missing_ok=True)
 
-        await loop.run_in_executor(None, _process)
+        await loop.run_in_executor(self.executor, _process)
         return filepath
 
 
@@ -0,0 +1,169 @@
+"""Move the MP4 moov atom in front of mdat without ffmpeg (like qt-faststart).
+
+Media data is copied in the kernel with copy_file_range where available, so
+only the moov atom (typically tens of KB) passes through Python.
+"""
+import os
+import struct
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+# Boxes on the path moov -> trak -> mdia -> minf -> stbl -> stco/co64
+CONTAINER_BOXES = frozenset((b"moov", b"trak", b"mdia", b"minf", b"stbl"))
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# (type, offset, size, header size)
+Box = Tuple[bytes, int, int, int]
+
+
+def _scan_boxes(fh, file_size: int) -> Optional[List[Box]]:
+    """List top-level boxes, or None if the layout is corrupt"""
+    boxes = []
+    offset = 0
+    while offset + 8 <= file_size:
+        fh.seek(offset)
+        size, box_type = struct.unpack(">I4s", fh.read(8))
+        header = 8
+        if size == 1:
+            # 64-bit box size follows the header
+            size = struct.unpack(">Q", fh.read(8))[0]
+            header = 16
+        elif size == 0:
+            # Box extends to end of file
+            size = file_size - offset
+        if size < header or offset + size > file_size:
+            return None
+        boxes.append((box_type, offset, size, header))
+        offset += size
+    if offset != file_size:
+        # Trailing bytes too short for a box header would be dropped
+        return None
+    return boxes
+
+
+def _patch_chunk_offsets(
+    buf: bytearray, start: int, end: int, lo: int, hi: int, delta: int
+) -> bool:
+    """Shift stco/co64 entries that point into [lo, hi) by delta"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return False
+
+        if box_type in CONTAINER_BOXES:
+            if not _patch_chunk_offsets(
+                buf, pos + header, pos + size, lo, hi, delta
+            ):
+                return False
+        elif box_type in (b"stco", b"co64"):
+            # Full box: version/flags, entry count, then the offsets
+            fmt = "I" if box_type == b"stco" else "Q"
+            count = struct.unpack_from(">I", buf, pos + header + 4)[0]
+            entries_at = pos + header + 8
+            if entries_at + count * struct.calcsize(fmt) > pos + size:
+                return False
+            entries = struct.unpack_from(f">{count}{fmt}", buf, entries_at)
+            patched = [e + delta if lo <= e < hi else e for e in entries]
+            if fmt == "I" and patched and max(patched) > 0xFFFFFFFF:
+                # Would need an stco -> co64 upgrade; leave it to ffmpeg
+                return False
+            struct.pack_into(f">{count}{fmt}", buf, entries_at, *patched)
+        elif box_type == b"cmov":
+            # Compressed movie header, offsets are not reachable
+            return False
+
+        pos += size
+    return True
+
+
+def _write_all(fd: int, data) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, length: int) -> None:
+    """Append src[offset:offset+length] to dst, in the kernel when possible"""
+    use_copy_file_range = hasattr(os, "copy_file_range")
+    while length > 0:
+        if use_copy_file_range:
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, length, offset)
+            except OSError:
+                # Cross-device or unsupported filesystem
+                use_copy_file_range = False
+                continue
+        else:
+            chunk = os.pread(src_fd, min(length, COPY_CHUNK_SIZE), offset)
+            _write_all(dst_fd, chunk)
+            copied = len(chunk)
+        if copied == 0:
+            raise OSError("Unexpected end of file")
+        offset += copied
+        length -= copied
+
+
+def faststart(filepath: Path) -> bool:
+    """Rewrite filepath with moov before mdat.
+
+    Returns True if the file is (now) faststart, False if its layout is not
+    supported and another tool should handle it.
+    """
+    try:
+        with open(filepath, "rb") as src:
+            boxes = _scan_boxes(src, os.fstat(src.fileno()).st_size)
+            if not boxes:
+                return False
+
+            # Fragmented files keep offsets in moof boxes; leave them to ffmpeg
+            types = [box[0] for box in boxes]
+            if b"moof" in types or b"mdat" not in types or types.count(b"moov") != 1:
+                return False
+
+            moov_index = types.index(b"moov")
+            mdat_index = types.index(b"mdat")
+            if moov_index < mdat_index:
+                return True
+
+            _, moov_offset, moov_size, moov_header = boxes[moov_index]
+            src.seek(moov_offset)
+            moov = bytearray(src.read(moov_size))
+            if struct.unpack_from(">I", moov)[0] == 0:
+                # "Extends to EOF" only works for the last box
+                return False
+
+            # Everything between the first mdat and moov moves down by moov_size
+            if not _patch_chunk_offsets(
+                moov,
+                moov_header,
+                moov_size,
+                boxes[mdat_index][1],
+                moov_offset,
+                moov_size,
+            ):
+                return False
+
+            temp_file = filepath.with_suffix(".temp.mp4")
+            try:
+                with open(temp_file, "wb", buffering=0) as dst:
+                    src_fd, dst_fd = src.fileno(), dst.fileno()
+                    for index, (_, offset, size, _) in enumerate(boxes):
+                        if index == mdat_index:
+                            _write_all(dst_fd, moov)
+                        if index != moov_index:
+                            _copy_range(src_fd, dst_fd, offset, size)
+                os.replace(temp_file, filepath)
+            except BaseException:
+                temp_file.unlink(missing_ok=True)
+                raise
+    except (OSError, struct.error):
+        return False
+    return True
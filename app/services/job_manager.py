@@ -1,45 +1,60 @@
 import asyncio
+import logging
+import os
 from typing import Dict, Optional, Set
 from datetime import datetime, timedelta
 from pathlib import Path
 import shutil
+from itertools import islice
+import orjson
 from app.models import JobStatus
 from app.config import settings
 from fastapi import WebSocket
 
+log = logging.getLogger(__name__)
+
+BROADCAST_INTERVAL = 0.1  # seconds, clients get at most 10 updates per second
+
+# Absolute, since mkdtemp returns absolute paths even for a relative TEMP_DIR
+TEMP_ROOT = Path(os.path.abspath(settings.temp_dir))
+
+# Jobs in these states hold no download slot and may be evicted
+TERMINAL_STATES = frozenset(("finished", "error", "cancelled"))
+
+
+class JobLimitExceeded(Exception):
+    """Job store is full of active jobs"""
+
 class JobManager:
     def __init__(self):
         self.jobs: Dict[str, JobStatus] = {}
         self.websockets: Dict[str, Set[WebSocket]] = {}
-        self.queues: Dict[str, asyncio.Queue] = {}
         self.cleanup_task: Optional[asyncio.Task] = None
+        self.broadcast_task: Optional[asyncio.Task] = None
+        # Jobs changed since the last broadcast; only their latest state is sent
+        self._dirty_jobs: Set[str] = set()
+        self._dirty_event = asyncio.Event()
         
     async def start(self):
-        """Start background cleanup task"""
+        """Start background cleanup and broadcast tasks"""
         if not self.cleanup_task:
             self.cleanup_task = asyncio.create_task(self._cleanup_loop())
+        if not self.broadcast_task:
+            self.broadcast_task = asyncio.create_task(self._broadcast_loop())
     
     async def stop(self):
         """Stop background tasks and cleanup"""
-        if self.cleanup_task:
-            self.cleanup_task.cancel()
-            try:
-                await self.cleanup_task
-            except asyncio.CancelledError:
-                pass
-        
-        # Cleanup all temp files
-        for job_id, job in self.jobs.items():
-            if job.filepath and Path(job.filepath).exists():
+        for task in (self.cleanup_task, self.broadcast_task):
+            if task:
+                task.cancel()
                 try:
-                    filepath = Path(job.filepath)
-                    # Удаляем только временные файлы
-                    if str(settings.temp_dir) in str(filepath):
-                        parent = filepath.parent
-                        if parent.exists():
-                            shutil.rmtree(parent, ignore_errors=True)
-                except:
+                    await task
+                except asyncio.CancelledError:
                     pass
+        
+        # Cleanup all temp files
+        for job in self.jobs.values():
+            self._remove_files(job)
     
     async def _cleanup_loop(self):
         """Periodically cleanup old jobs and files"""
@@ -49,42 +64,88 @@ class JobManager:
                 await self.cleanup_old_jobs()
             except asyncio.CancelledError:
                 break
-            except Exception as e:
-                print(f"Cleanup error: {e}")
+            except Exception:
+                log.exception("Cleanup error")
+    
+    async def _broadcast_loop(self):
+        """Send the latest state of changed jobs to websocket clients"""
+        while True:
+            try:
+                await self._dirty_event.wait()
+                self._dirty_event.clear()
+                dirty, self._dirty_jobs = self._dirty_jobs, set()
+
+                for job_id in dirty:
+                    job = self.jobs.get(job_id)
+                    if job and job_id in self.websockets:
+                        # orjson encodes the dataclass natively, once per flush
+                        payload = orjson.dumps(job)
+                        await self.broadcast(job_id, payload)
+
+                # Cap the send rate; updates arriving meanwhile are coalesced
+                await asyncio.sleep(BROADCAST_INTERVAL)
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                log.exception("Broadcast error")
     
     async def cleanup_old_jobs(self):
         """Remove old jobs and their files"""
-        now = datetime.now()
-        ttl = timedelta(hours=settings.job_ttl_hours)
-        
+        cutoff = datetime.now() - timedelta(hours=settings.job_ttl_hours)
+
+        # Jobs are inserted in creation order, so stop at the first live one
         expired_jobs = []
         for job_id, job in self.jobs.items():
-            if job.created_at and now - job.created_at > ttl:
-                expired_jobs.append(job_id)
+            if job.created_at >= cutoff:
+                break
+            expired_jobs.append(job_id)
         
         for job_id in expired_jobs:
             await self.remove_job(job_id)
     
     async def create_job(self, job_id: str) -> JobStatus:
         """Create a new job"""
+        # Evict the oldest finished jobs (dicts keep insertion order) to bound
+        # memory; active jobs are never dropped
+        excess = len(self.jobs) - settings.max_jobs + 1
+        if excess > 0:
+            evictable = list(
+                islice(
+                    (
+                        job_id
+                        for job_id, job in self.jobs.items()
+                        if job.status in TERMINAL_STATES
+                    ),
+                    excess,
+                )
+            )
+            if len(evictable) < excess:
+                raise JobLimitExceeded("Too many active jobs, try again later")
+            for old_job_id in evictable:
+                await self.remove_job(old_job_id)
+
         job = JobStatus(job_id=job_id, status="queued")
         self.jobs[job_id] = job
-        self.queues[job_id] = asyncio.Queue()
         return job
     
     async def update_job(self, job_id: str, **kwargs):
         """Update job status and notify websocket clients"""
-        if job_id not in self.jobs:
+        self.update_state(job_id, **kwargs)
+
+    def update_state(self, job_id: str, **kwargs):
+        """Synchronous update; must run on the event loop thread"""
+        job = self.jobs.get(job_id)
+        if job is None:
             return
         
-        job = self.jobs[job_id]
         for key, value in kwargs.items():
             if hasattr(job, key):
                 setattr(job, key, value)
         job.updated_at = datetime.now()
         
-        # Notify websocket clients
-        await self.broadcast(job_id, job.dict())
+        # Notify websocket clients; bursts of updates coalesce into one send
+        self._dirty_jobs.add(job_id)
+        self._dirty_event.set()
     
     async def get_job(self, job_id: str) -> Optional[JobStatus]:
         """Get job status"""
@@ -95,28 +156,30 @@ class JobManager:
         job = self.jobs.get(job_id)
         if job:
             # Cleanup file
-            if job.filepath and Path(job.filepath).exists():
-                try:
-                    filepath = Path(job.filepath)
-                    if str(settings.temp_dir) in str(filepath):
-                        parent = filepath.parent
-                        if parent.exists():
-                            shutil.rmtree(parent, ignore_errors=True)
-                except:
-                    pass
+            self._remove_files(job)
             
             # Remove from tracking
             self.jobs.pop(job_id, None)
-            self.queues.pop(job_id, None)
             
             # Close websockets
             for ws in self.websockets.get(job_id, set()).copy():
                 try:
                     await ws.close()
-                except:
-                    pass
+                except Exception:
+                    log.debug(
+                        "Failed to close websocket of job %s", job_id, exc_info=True
+                    )
             self.websockets.pop(job_id, None)
     
+    def _remove_files(self, job: JobStatus):
+        """Delete the job's temp download dir; missing files are not an error"""
+        if not job.filepath:
+            return
+        parent = Path(os.path.abspath(job.filepath)).parent
+        # Удаляем только временные файлы (и никогда сам temp_dir)
+        if parent != TEMP_ROOT and parent.is_relative_to(TEMP_ROOT):
+            shutil.rmtree(parent, ignore_errors=True)
+    
     async def add_websocket(self, job_id: str, websocket: WebSocket):
         """Add websocket connection for job"""
         if job_id not in self.websockets:
@@ -130,18 +193,25 @@ class JobManager:
             if not self.websockets[job_id]:
                 self.websockets.pop(job_id, None)
     
-    async def broadcast(self, job_id: str, data: dict):
-        """Broadcast to all websocket clients for a job"""
+    async def broadcast(self, job_id: str, payload: bytes):
+        """Broadcast a pre-serialized JSON payload to all websocket clients for a job"""
+        sockets = self.websockets.get(job_id)
+        if not sockets:
+            return
+
+        # Snapshot: the set may change while sends are awaited
         dead_sockets = set()
-        for ws in self.websockets.get(job_id, set()).copy():
+        for ws in tuple(sockets):
             try:
-                await ws.send_json(data)
-            except:
+                await ws.send_bytes(payload)
+            except Exception:
                 dead_sockets.add(ws)
         
-        # Remove dead connections
-        for ws in dead_sockets:
-            await self.remove_websocket(job_id, ws)
+        # Remove dead connections in one step
+        if dead_sockets:
+            sockets -= dead_sockets
+            if not sockets and self.websockets.get(job_id) is sockets:
+                self.websockets.pop(job_id, None)
 
 # Global instance
 job_manager = JobManager()
@@ -0,0 +1,88 @@
+import logging
+import time
+from typing import Optional
+from cachetools import LRUCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from app.config import settings
+
+RATE_LIMIT_WINDOW = 60.0  # seconds
+REDIS_RETRY_DELAY = 5.0  # seconds on the local limiter after a Redis failure
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    def __init__(self):
+        # client_ip -> (last refill time, tokens left); least recently seen
+        # IPs are dropped once full, so memory stays capped under IP floods
+        self.buckets: LRUCache = LRUCache(maxsize=settings.rate_limit_max_clients)
+        self.redis: Optional[Redis] = None
+        # While in the future, Redis is known bad and skipped
+        self._redis_retry_at = 0.0
+        self._redis_failing = False
+
+    async def start(self):
+        """Connect to Redis when configured"""
+        if settings.redis_url and not self.redis:
+            self.redis = Redis.from_url(
+                settings.redis_url,
+                socket_connect_timeout=0.5,
+                socket_timeout=0.5,
+            )
+
+    async def stop(self):
+        """Close the Redis connection pool"""
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+
+    async def check(self, client_ip: str) -> bool:
+        """Check the limit in Redis if available, otherwise locally"""
+        if self.redis and time.monotonic() >= self._redis_retry_at:
+            try:
+                allowed = await self._check_redis(client_ip)
+            except (RedisError, OSError):
+                # Back off so a dead Redis does not add a timeout to every request
+                self._redis_retry_at = time.monotonic() + REDIS_RETRY_DELAY
+                if not self._redis_failing:
+                    self._redis_failing = True
+                    log.warning(
+                        "Redis rate limiting unavailable, using per-worker limits",
+                        exc_info=True,
+                    )
+            else:
+                if self._redis_failing:
+                    self._redis_failing = False
+                    log.info("Redis rate limiting restored")
+                return allowed
+        return self._check_local(client_ip)
+
+    async def _check_redis(self, client_ip: str) -> bool:
+        """Fixed-window counter shared by all workers (INCR + EXPIRE NX)"""
+        key = f"ratelimit:{client_ip}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incr(key)
+            pipe.expire(key, int(RATE_LIMIT_WINDOW), nx=True)
+            count, _ = await pipe.execute()
+        return count <= settings.rate_limit_per_minute
+
+    def _check_local(self, client_ip: str) -> bool:
+        """Token-bucket rate limiting: bursts up to the limit, refills per window"""
+        now = time.monotonic()
+        limit = settings.rate_limit_per_minute
+
+        last, tokens = self.buckets.get(client_ip, (now, float(limit)))
+        tokens = min(limit, tokens + (now - last) * limit / RATE_LIMIT_WINDOW)
+
+        # Check limit
+        if tokens < 1:
+            self.buckets[client_ip] = (now, tokens)
+            return False
+
+        self.buckets[client_ip] = (now, tokens - 1)
+        return True
+
+
+# Global instance
+rate_limiter = RateLimiter()
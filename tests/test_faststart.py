@@ -0,0 +1,90 @@
+import struct
+
+from app.services.faststart import CONTAINER_BOXES, faststart
+
+CHUNK = 16
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def chunk_table(box_type: bytes, offsets) -> bytes:
+    fmt = "I" if box_type == b"stco" else "Q"
+    entries = struct.pack(f">{len(offsets)}{fmt}", *offsets)
+    return box(box_type, struct.pack(">II", 0, len(offsets)) + entries)
+
+
+def moov(stco_offsets, co64_offsets) -> bytes:
+    def trak(table: bytes) -> bytes:
+        return box(b"trak", box(b"mdia", box(b"minf", box(b"stbl", table))))
+
+    return box(
+        b"moov",
+        trak(chunk_table(b"stco", stco_offsets))
+        + trak(chunk_table(b"co64", co64_offsets)),
+    )
+
+
+def read_offsets(data: bytes, start: int = 0, end: int = None):
+    """Chunk offsets of every stco/co64 table, in file order"""
+    end = len(data) if end is None else end
+    offsets = []
+    pos = start
+    while pos < end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        if box_type in CONTAINER_BOXES:
+            offsets += read_offsets(data, pos + 8, pos + size)
+        elif box_type in (b"stco", b"co64"):
+            fmt = "I" if box_type == b"stco" else "Q"
+            count = struct.unpack_from(">I", data, pos + 12)[0]
+            offsets += struct.unpack_from(f">{count}{fmt}", data, pos + 16)
+        pos += size
+    return offsets
+
+
+def make_file(tmp_path, moov_last: bool = True):
+    ftyp = box(b"ftyp", b"isom\x00\x00\x02\x00isommp41")
+    chunks = b"".join(bytes([i]) * CHUNK for i in range(1, 5))
+    mdat_payload_at = len(ftyp) + 8
+    if not moov_last:
+        # Placeholder of the right size to learn where mdat ends up
+        mdat_payload_at += len(moov([0, 0], [0, 0]))
+    offsets = [mdat_payload_at + i * CHUNK for i in range(4)]
+    header = moov(offsets[:2], offsets[2:])
+    mdat = box(b"mdat", chunks)
+    data = ftyp + mdat + header if moov_last else ftyp + header + mdat
+
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+    return path, data
+
+
+def test_moves_moov_and_keeps_chunk_offsets(tmp_path):
+    path, original = make_file(tmp_path)
+    old_offsets = read_offsets(original)
+
+    assert faststart(path)
+
+    data = path.read_bytes()
+    assert len(data) == len(original)
+    assert data.index(b"moov") < data.index(b"mdat")
+    new_offsets = read_offsets(data)
+    assert len(new_offsets) == len(old_offsets) == 4
+    for old, new in zip(old_offsets, new_offsets):
+        assert data[new:new + CHUNK] == original[old:old + CHUNK]
+
+
+def test_leaves_faststart_file_unchanged(tmp_path):
+    path, original = make_file(tmp_path, moov_last=False)
+
+    assert faststart(path)
+    assert path.read_bytes() == original
+
+
+def test_rejects_trailing_bytes(tmp_path):
+    path, original = make_file(tmp_path)
+    path.write_bytes(original + b"\x00\x00\x00")
+
+    assert not faststart(path)
+    assert path.read_bytes() == original + b"\x00\x00\x00"